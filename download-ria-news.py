@@ -1,13 +1,17 @@
 import argparse
 import asyncio
-import csv
+import gzip
 import logging
 from concurrent.futures import ProcessPoolExecutor
 import datetime
+import re
 from multiprocessing import cpu_count
-from nltk.tokenize import sent_tokenize
+from urllib.parse import urljoin
+import socket
 import aiohttp
-from bs4 import BeautifulSoup
+from aiohttp.resolver import AsyncResolver
+import lxml.html
+from lxml import etree
 import ssl
 import certifi
 
@@ -21,8 +25,48 @@ logging.basicConfig(
 logger = logging.getLogger(name="RiaAgencyParser")
 
 
+# One parser per process: allocator and string-table setup is a noticeable
+# share of parse time on ~50 KB documents, so don't rebuild it per call.
+# ria.ru serves utf-8, so encoding detection is skipped too.
+_HTML_PARSER = lxml.html.HTMLParser(
+    remove_blank_text=True, huge_tree=True, encoding="utf-8"
+)
+
+# Compiled once; each application is a single C-level pass over the tree.
+_TITLE_XPATH = etree.XPath("//*[self::div or self::h1][@class='article__title']")
+_TEXT_XPATH = etree.XPath("//div[@class='article__text']")
+_DATE_XPATH = etree.XPath("//div[@class='article__info-date']/a")
+_LIST_URL_XPATH = etree.XPath("//a[@class='list-item__title']/@href")
+_NEXT_PAGE_XPATH = etree.XPath("//div[@class='list-more']/@data-url")
+
+# First sentence of every article is the dateline lead; drop everything up to
+# and including the first sentence terminator.
+_LEAD_RE = re.compile(r'^.*?[.!?]\s+', re.S)
+
+_CSV_FIELDS = ("url", "title", "date", "text")
+
+
+def _esc(field) -> str:
+    if field is None:
+        return ""
+    field = str(field)
+    if '"' in field:
+        field = field.replace('"', '""')
+    return field
+
+
+def _format_row(row: dict) -> str:
+    # Quote-all is always-valid CSV and skips the per-field dialect checks of
+    # the csv module; only embedded quotes need doubling.
+    return '"%s","%s","%s","%s"\n' % tuple(_esc(row[k]) for k in _CSV_FIELDS)
+
+
 class RiaAgencyParser:
-    default_parser = "html.parser"
+    n_fetch_workers = 128
+    n_date_workers = 8
+    url_queue_size = 1024
+    row_queue_size = 10_000
+    write_batch_size = 512
 
     def __init__(self, *, max_workers: int, outfile_name: str, from_date: str, to_date: str):
         self._endpoint = "https://ria.ru/"
@@ -30,11 +74,13 @@ class RiaAgencyParser:
         self._sess = None
         self._connector = None
 
-        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._max_workers = max_workers
+        self._executor = None
 
         self._outfile_name = outfile_name
         self._outfile = None
-        self._csv_writer = None
+        self._pending_rows = []
+        self._write_q = None
         self.timeouts = aiohttp.ClientTimeout(total=60, connect=60)
         self._sslcontext = ssl.create_default_context(cafile=certifi.where())
 
@@ -52,41 +98,72 @@ class RiaAgencyParser:
             date_start += datetime.timedelta(days=1)
 
     @property
-    def writer(self):
-        if self._csv_writer is None:
-            self._outfile = open(self._outfile_name, "w", 1, encoding='utf-8')
-            self._csv_writer = csv.DictWriter(
-                self._outfile, fieldnames=["url", "title", 'date', "text"]
-            )
-            self._csv_writer.writeheader()
+    def executor(self):
+        # Created on first parse so that crawls which never reach an article
+        # (bad date range, network down) don't spawn worker processes at all.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
 
-        return self._csv_writer
+        return self._executor
+
+    @property
+    def outfile(self):
+        if self._outfile is None:
+            # Level 1 keeps compression far cheaper than the network while
+            # shrinking a multi-year crawl by a factor of 3-5 on disk.
+            outfile_name = self._outfile_name
+            if not outfile_name.endswith(".gz"):
+                outfile_name += ".gz"
+            self._outfile = gzip.open(outfile_name, "wb", compresslevel=1)
+            self._outfile.write(('"%s","%s","%s","%s"\n' % _CSV_FIELDS).encode("utf-8"))
+
+        return self._outfile
+
+    async def _open_session(self):
+        if self._sess is None:
+            # Everything goes to one host, so cap connections below the worker
+            # count and keep them alive long: each TLS handshake is then paid
+            # once and amortised over the whole crawl. ria.ru sits behind a
+            # CDN whose IPs are stable for hours, so resolve once per day.
+            self._connector = aiohttp.TCPConnector(
+                resolver=AsyncResolver(nameservers=["1.1.1.1", "8.8.8.8"]),
+                use_dns_cache=True,
+                ttl_dns_cache=24 * 60 * 60,
+                family=socket.AF_INET,
+                limit=1024,
+                limit_per_host=256,
+                keepalive_timeout=60,
+                ssl=self._sslcontext,
+            )
+            self._sess = aiohttp.ClientSession(
+                connector=self._connector,
+                timeout=self.timeouts,
+                headers={"Accept-Encoding": "gzip, deflate"},
+            )
 
-    async def fetch(self, url: str):
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(
-                use_dns_cache=True, ttl_dns_cache=60 * 60, limit=1024),
-                timeout=self.timeouts) as session:
-            async with session.get(url, ssl=self._sslcontext) as response:
-                return await response.text()
+    async def fetch(self, url: str) -> bytes:
+        # Raw bytes: decoding happens once inside the C parser (pinned to
+        # utf-8 by _HTML_PARSER) instead of as a str pass in the event loop.
+        async with self._sess.get(url) as response:
+            return await response.read()
 
     @staticmethod
-    def parse_article_html(html: str):
-        doc_tree = BeautifulSoup(html, "html.parser")
-        if doc_tree.find(["div", "h1"], attrs={"class": "article__title"}):
-            title = doc_tree.find(["div", "h1"], attrs={"class": "article__title"}).text
-        else:
-            title = None
+    def parse_article_html(html: bytes):
+        doc_tree = lxml.html.fromstring(html, parser=_HTML_PARSER)
+
+        title_nodes = _TITLE_XPATH(doc_tree)
+        title = title_nodes[0].text_content() if title_nodes else None
 
-        if doc_tree.findAll("div", class_="article__text"):
-            text = ' '.join([i.text for i in doc_tree.findAll("div", class_="article__text")])
-            sents = sent_tokenize(text)
-            text = ' '.join(sents[1:])
+        text_nodes = _TEXT_XPATH(doc_tree)
+        if text_nodes:
+            text = ' '.join(i.text_content() for i in text_nodes)
+            text = _LEAD_RE.sub('', text, count=1)
         else:
             text = None
 
-        if doc_tree.find("div", class_="article__info-date").find("a"):
-            date_element = doc_tree.find("div", class_="article__info-date").find("a")
-            date_text = date_element.text.strip()
+        date_nodes = _DATE_XPATH(doc_tree)
+        if date_nodes:
+            date_text = date_nodes[0].text_content().strip()
             date_time = date_text.split()
             date_part = date_time[1]
         else:
@@ -95,79 +172,180 @@ class RiaAgencyParser:
         return {"title": title, "date": date_part, "text": text}
 
     @staticmethod
-    def _extract_urls_from_html(html: str):
-        doc_tree = BeautifulSoup(html, "html.parser")
-        news_list = doc_tree.find_all("a", {"class": "list-item__title"})
-        return tuple(news.get("href") for news in news_list)
-
-    async def _fetch_all_news_on_page(self, initial_html: str):
-        news_urls = []
-        html = initial_html
-        page_news_urls = await asyncio.to_thread(self._extract_urls_from_html, html)
-        news_urls.extend(page_news_urls)
-
-        tasks = [asyncio.create_task(self.fetch(url)) for url in set(news_urls)]
-        fetched_raw_news = {}
-        for i, task in enumerate(tasks):
+    def _extract_urls_from_html(html: bytes):
+        doc_tree = lxml.html.fromstring(html, parser=_HTML_PARSER)
+        return tuple(_LIST_URL_XPATH(doc_tree))
+
+    @staticmethod
+    def _extract_next_page_url(html: bytes):
+        doc_tree = lxml.html.fromstring(html, parser=_HTML_PARSER)
+        next_urls = _NEXT_PAGE_XPATH(doc_tree)
+        return next_urls[0] if next_urls else None
+
+    async def _process_article(self, url: str):
+        try:
+            html = await self.fetch(url)
+        except asyncio.TimeoutError:
+            logger.error(f"Cannot fetch {url}. Timeout")
+            return
+        except aiohttp.ClientError as exc:
+            logger.error(f"Cannot fetch {url}: {exc}")
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+            parse_res = await loop.run_in_executor(
+                self.executor, RiaAgencyParser.parse_article_html, html
+            )
+        except Exception as e:
+            logger.exception(f"Cannot parse {url}: {e}")
+            return
+
+        parse_res["url"] = url
+        await self._write_q.put(parse_res)
+
+    def _write_row(self, row: dict):
+        self._pending_rows.append(row)
+        self._n_downloaded += 1
+        if len(self._pending_rows) >= self.write_batch_size:
+            self._flush_rows()
+
+    def _flush_rows(self):
+        if self._pending_rows:
+            blob = ''.join(_format_row(row) for row in self._pending_rows)
+            self.outfile.write(blob.encode("utf-8"))
+            self._pending_rows.clear()
+
+    async def _writer_task(self):
+        # Single consumer: file writes never happen on the fetch/parse path.
+        while True:
+            row = await self._write_q.get()
             try:
-                fetch_res = await task
-            except aiohttp.ClientResponseError as exc:
-                logger.error(f"Cannot fetch {exc.request_info.url}: {exc}")
-            except asyncio.TimeoutError:
-                logger.exception("Cannot fetch. Timeout")
-            else:
-                fetched_raw_news[news_urls[i]] = fetch_res
-
-        parse_tasks = {url: asyncio.to_thread(self.parse_article_html, html) for url, html in fetched_raw_news.items()}
-        parsed_news = []
-
-        for url, task in parse_tasks.items():
+                if row is None:
+                    self._flush_rows()
+                    return
+                self._write_row(row)
+            finally:
+                self._write_q.task_done()
+
+    async def _article_worker(self, queue: asyncio.Queue):
+        while True:
+            url = await queue.get()
             try:
-                parse_res = await task
-            except Exception as e:
-                logger.exception(f"Cannot parse {url}: {e}")
-            else:
-                parse_res["url"] = url
-                parsed_news.append(parse_res)
-
-        if parsed_news:
-            self.writer.writerows(parsed_news)
-            self._n_downloaded += len(parsed_news)
-
-        return len(parsed_news)
-
-    async def _producer(self):
-        for date in self.dates_countdown:
-            news_page_url = f"{self._endpoint}/{date}"
-
+                await self._process_article(url)
+            except Exception:
+                # A worker must outlive any single bad URL; a dead worker is
+                # silently reaped in run() and shrinks the pool for good.
+                logger.exception(f"Unhandled error processing {url}")
+            finally:
+                queue.task_done()
+
+    async def _process_date(self, date: str, queue: asyncio.Queue):
+        news_page_url = f"{self._endpoint}/{date}"
+        seen_pages = set()
+        seen_news = set()
+        n_queued = 0
+
+        while news_page_url and news_page_url not in seen_pages:
+            seen_pages.add(news_page_url)
             try:
-                html = await asyncio.create_task(self.fetch(news_page_url))
+                html = await self.fetch(news_page_url)
             except aiohttp.ClientResponseError:
                 logger.exception(f"Cannot fetch {news_page_url}")
+                break
             except aiohttp.ClientConnectionError:
                 logger.exception(f"Cannot fetch {news_page_url}")
+                break
             except BaseException as e:
                 logger.info(f"Cannot fetch {news_page_url}: {e}")
-            else:
-                n_proccessed_news = await self._fetch_all_news_on_page(html)
+                break
+
+            try:
+                page_news_urls = self._extract_urls_from_html(html)
+            except etree.ParserError as e:
+                # An empty 200 body makes lxml raise; treat it like a page
+                # with no news rather than aborting the crawl.
+                logger.info(f"Cannot parse {news_page_url}: {e}")
+                break
+            news_urls = [
+                url for url in dict.fromkeys(page_news_urls) if url not in seen_news
+            ]
+            seen_news.update(news_urls)
+
+            for url in news_urls:
+                await queue.put(url)
+            n_queued += len(news_urls)
+
+            if not news_urls:
+                break
+
+            next_page = self._extract_next_page_url(html)
+            news_page_url = urljoin(self._endpoint, next_page) if next_page else None
+
+        if n_queued == 0:
+            logger.info(f"News not found for {date}.")
+
+        logger.info(
+            f"{date} processed ({n_queued} news queued). "
+            f"{self._n_downloaded} news saved totally."
+        )
+
+    async def _producer(self, queue: asyncio.Queue):
+        sem = asyncio.Semaphore(self.n_date_workers)
+
+        async def bounded(date):
+            async with sem:
+                await self._process_date(date, queue)
 
-                if n_proccessed_news == 0:
-                    logger.info(f"News not found at {news_page_url}.")
+        await asyncio.gather(*(bounded(date) for date in self.dates_countdown))
 
-                logger.info(
-                    f"{news_page_url} processed ({n_proccessed_news} news). "
-                    f"{self._n_downloaded} news saved totally."
-                )
+    async def _crawl(self, queue: asyncio.Queue):
+        await self._producer(queue)
+        await queue.join()
 
     async def run(self):
-        await self._producer()
+        await self._open_session()
+        # Touch the outfile up front: an unwritable path should crash here,
+        # not leave the writer dead and every queue blocked.
+        self.outfile
+        queue = asyncio.Queue(maxsize=self.url_queue_size)
+        self._write_q = asyncio.Queue(maxsize=self.row_queue_size)
+        writer = asyncio.create_task(self._writer_task())
+        workers = [
+            asyncio.create_task(self._article_worker(queue))
+            for _ in range(self.n_fetch_workers)
+        ]
+        try:
+            crawl = asyncio.create_task(self._crawl(queue))
+            done, _ = await asyncio.wait({crawl, writer}, return_when=asyncio.FIRST_COMPLETED)
+            if writer in done:
+                # The writer only finishes before the crawl by crashing;
+                # surface its exception instead of deadlocking on full queues.
+                crawl.cancel()
+                await asyncio.gather(crawl, return_exceptions=True)
+                writer.result()
+            await crawl
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self._sess.close()
+            if self._executor is not None:
+                self._executor.shutdown()
+            if not writer.done():
+                await self._write_q.put(None)
+                await writer
+            if self._outfile is not None:
+                self._outfile.close()
 
 
 def main():
     parser = argparse.ArgumentParser(description="Downloads news from Lenta.Ru")
 
     parser.add_argument(
-        "--outfile", default="ria-agency-news.csv", help="name of result file"
+        "--outfile",
+        default="ria-agency-news.csv.gz",
+        help="name of result file (gzip-compressed CSV; '.gz' is appended if missing)",
     )
 
     parser.add_argument(